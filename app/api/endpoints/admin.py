@@ -1,32 +1,88 @@
-from typing import Any, List
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Path, Query, status
-from prisma.models import Chat, Message, User
-
-from app.schemas.user import UserOut, UserUpdate
-from app.services.auth import get_current_admin_user, update_user
+from fastapi.responses import ORJSONResponse
+from prisma.models import Chat, User
+from prisma.partials import PublicUser
+from pydantic import TypeAdapter
+
+from app.core.cache import get_json, set_json
+from app.core.config import settings
+from app.schemas.chat import ChatPage
+from app.schemas.token import TokenPayload
+from app.schemas.user import UserOut, UserPage, UserUpdate
+from app.services.auth import (
+    delete_user_account,
+    forget_user,
+    get_current_admin_user,
+    update_user,
+)
+from app.services.chat import CHAT_INCLUDE
+from app.services.stats import (
+    AI_MESSAGES_TOTAL,
+    CHATS_TOTAL,
+    MESSAGES_TOTAL,
+    USERS_TOTAL,
+    get_stats,
+)
 
 router = APIRouter()
 
+STATS_CACHE_KEY = "admin:stats:v1"
+
+# Built once: list pages are validated and serialized in a single pass each
+_users_out = TypeAdapter(List[UserOut])
+_chats_out = TypeAdapter(List[Chat])
+
+# The included owner and participant users are full models; prisma can't
+# narrow the columns of an included relation, so drop the hash when dumping
+CHAT_DUMP_EXCLUDE = {
+    "__all__": {
+        "owner": {"passwordHash"},
+        "participants": {"__all__": {"user": {"passwordHash"}}},
+    }
+}
+
+# Newest first, with the ID as a tie-breaker so the order is total
+PAGE_ORDER = [{"createdAt": "desc"}, {"id": "desc"}]
+
 
-@router.get("/users", response_model=List[UserOut])
+def _page_after(cursor: Optional[str]) -> Dict[str, Any]:
+    """Query arguments that start a page just after the record `cursor`."""
+    if not cursor:
+        return {}
+    return {"cursor": {"id": cursor}, "skip": 1}
+
+
+@router.get("/users", response_model=UserPage)
 async def get_all_users(
-    skip: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None),
     limit: int = Query(100, ge=1, le=500),
-    current_user: User = Depends(get_current_admin_user),
+    current_user: TokenPayload = Depends(get_current_admin_user),
 ) -> Any:
-    """Get all users (admin only)."""
-    users = await User.prisma().find_many(
-        skip=skip,
+    """Get all users, newest first (admin only). Pass `next_cursor` to get the next page."""
+    # Keyset pagination: seek past the cursor instead of scanning an OFFSET
+    users = await PublicUser.prisma().find_many(
         take=limit,
+        order_by=PAGE_ORDER,
+        **_page_after(cursor),
+    )
+    next_cursor = users[-1].id if len(users) == limit else None
+    
+    # Returning a response directly skips FastAPI's per-item re-validation;
+    # response_model is kept for the OpenAPI schema
+    items = _users_out.validate_python(users, from_attributes=True)
+    return ORJSONResponse(
+        {"items": _users_out.dump_python(items, mode="json"), "next_cursor": next_cursor}
     )
-    return users
 
 
 @router.get("/users/{user_id}", response_model=UserOut)
 async def get_user(
     user_id: str = Path(...),
-    current_user: User = Depends(get_current_admin_user),
+    current_user: TokenPayload = Depends(get_current_admin_user),
 ) -> Any:
     """Get a specific user (admin only)."""
     user = await User.prisma().find_unique(where={"id": user_id})
@@ -42,94 +98,94 @@ async def get_user(
 async def update_user_admin(
     user_update: UserUpdate,
     user_id: str = Path(...),
-    current_user: User = Depends(get_current_admin_user),
+    current_user: TokenPayload = Depends(get_current_admin_user),
 ) -> Any:
     """Update a user (admin only)."""
-    user = await User.prisma().find_unique(where={"id": user_id})
-    if not user:
+    updated_user = await update_user(user_id, user_update)
+    if not updated_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"User with ID {user_id} not found",
         )
-    
-    updated_user = await update_user(user_id, user_update)
     return updated_user
 
 
 @router.delete("/users/{user_id}")
 async def delete_user(
     user_id: str = Path(...),
-    current_user: User = Depends(get_current_admin_user),
+    current_user: TokenPayload = Depends(get_current_admin_user),
 ) -> Any:
     """Delete a user (admin only)."""
-    user = await User.prisma().find_unique(where={"id": user_id})
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"User with ID {user_id} not found",
-        )
-    
     # Don't allow admins to delete themselves
-    if user_id == current_user.id:
+    if user_id == current_user.sub:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Admins cannot delete their own account",
         )
     
-    await User.prisma().delete(where={"id": user_id})
+    deleted_user = await delete_user_account(user_id)
+    if not deleted_user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"User with ID {user_id} not found",
+        )
     return {"success": True}
 
 
-@router.get("/chats", response_model=List[Chat])
+@router.get("/chats", response_model=ChatPage)
 async def get_all_chats(
-    skip: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None),
     limit: int = Query(100, ge=1, le=500),
-    current_user: User = Depends(get_current_admin_user),
+    current_user: TokenPayload = Depends(get_current_admin_user),
 ) -> Any:
-    """Get all chats (admin only)."""
+    """Get all chats, newest first (admin only). Pass `next_cursor` to get the next page."""
     chats = await Chat.prisma().find_many(
-        skip=skip,
         take=limit,
-        include={
-            "owner": True,
-            "participants": {
-                "include": {
-                    "user": True
-                }
-            }
+        order_by=PAGE_ORDER,
+        include={"owner": True, **CHAT_INCLUDE},
+        **_page_after(cursor),
+    )
+    next_cursor = chats[-1].id if len(chats) == limit else None
+    return ORJSONResponse(
+        {
+            "items": _chats_out.dump_python(chats, mode="json", exclude=CHAT_DUMP_EXCLUDE),
+            "next_cursor": next_cursor,
         }
     )
-    return chats
 
 
 @router.get("/statistics")
 async def get_system_stats(
-    current_user: User = Depends(get_current_admin_user),
+    current_user: TokenPayload = Depends(get_current_admin_user),
 ) -> Any:
     """Get system statistics (admin only)."""
-    total_users = await User.prisma().count()
-    total_chats = await Chat.prisma().count()
-    total_messages = await Message.prisma().count()
+    # The counts change slowly, so serve dashboard polling from the cache
+    cached = await get_json(STATS_CACHE_KEY)
+    if cached is not None:
+        return cached
     
-    # Get user stats by auth provider
-    users_by_provider = await User.prisma().group_by(
-        by=["authProvider"],
-        _count={"id": True},
-    )
-    
-    # Get recent signups (last 7 days)
-    from datetime import datetime, timedelta
     one_week_ago = datetime.utcnow() - timedelta(days=7)
-    recent_signups = await User.prisma().count(
-        where={"createdAt": {"gte": one_week_ago.isoformat()}}
-    )
     
-    # Get AI message stats
-    ai_messages = await Message.prisma().count(
-        where={"isAI": True}
+    # Totals come from the counter table instead of COUNT(*) scans; the
+    # remaining queries are independent, so issue them together
+    counters, users_by_provider, recent_signups = await asyncio.gather(
+        get_stats(),
+        # User stats by auth provider
+        User.prisma().group_by(
+            by=["authProvider"],
+            _count={"id": True},
+        ),
+        # Recent signups (last 7 days)
+        User.prisma().count(
+            where={"createdAt": {"gte": one_week_ago.isoformat()}}
+        ),
     )
+    total_users = counters.get(USERS_TOTAL, 0)
+    total_chats = counters.get(CHATS_TOTAL, 0)
+    total_messages = counters.get(MESSAGES_TOTAL, 0)
+    ai_messages = counters.get(AI_MESSAGES_TOTAL, 0)
     
-    return {
+    stats = {
         "total_users": total_users,
         "total_chats": total_chats,
         "total_messages": total_messages,
@@ -138,30 +194,36 @@ async def get_system_stats(
         "ai_messages": ai_messages,
         "user_messages": total_messages - ai_messages,
     }
+    await set_json(STATS_CACHE_KEY, stats, ttl=settings.STATS_CACHE_TTL_SECONDS)
+    
+    return stats
 
 
 @router.post("/make-admin/{user_id}")
 async def make_user_admin(
     user_id: str = Path(...),
-    current_user: User = Depends(get_current_admin_user),
+    current_user: TokenPayload = Depends(get_current_admin_user),
 ) -> Any:
     """Promote a user to admin (admin only)."""
-    user = await User.prisma().find_unique(where={"id": user_id})
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"User with ID {user_id} not found",
-        )
-    
-    if user.role == "ADMIN":
+    # Conditional update so the "already an admin" check can't race
+    promoted = await User.prisma().update_many(
+        where={"id": user_id, "role": {"not": "ADMIN"}},
+        data={"role": "ADMIN"},
+    )
+    if not promoted:
+        # Only the unhappy path pays for a lookup, to tell the two cases apart
+        user = await User.prisma().find_unique(where={"id": user_id})
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"User with ID {user_id} not found",
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User is already an admin",
         )
     
-    updated_user = await User.prisma().update(
-        where={"id": user_id},
-        data={"role": "ADMIN"},
-    )
+    await forget_user(user_id)
+    updated_user = await PublicUser.prisma().find_unique(where={"id": user_id})
     
     return {"success": True, "user": updated_user}
\ No newline at end of file
@@ -1,11 +1,12 @@
 from fastapi import APIRouter, Body, Depends, HTTPException, status
+from prisma.models import User
 from typing import Any
 from datetime import timedelta
 
-from app.services.auth import get_current_active_user
+from app.services.auth import get_current_user
 from app.core.config import settings
-from app.models.token import Token
-from app.models.user import User, UserOut, UserUpdate
+from app.schemas.token import Token
+from app.schemas.user import UserOut, UserUpdate
 from app.services.auth import authenticate_google_user, authenticate_apple_user, update_user, create_access_token
 
 router = APIRouter()
@@ -23,7 +24,9 @@ async def login_google(
         )
     
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(subject=user.id, expires_delta=access_token_expires)
+    access_token = create_access_token(
+        subject=user.id, expires_delta=access_token_expires, role=user.role
+    )
     
     return {
         "access_token": access_token,
@@ -44,7 +47,9 @@ async def login_apple(
         )
     
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(subject=user.id, expires_delta=access_token_expires)
+    access_token = create_access_token(
+        subject=user.id, expires_delta=access_token_expires, role=user.role
+    )
     
     return {
         "access_token": access_token,
@@ -54,7 +59,7 @@ async def login_apple(
 
 @router.get("/me", response_model=UserOut)
 async def read_users_me(
-    current_user: User = Depends(get_current_active_user),
+    current_user: User = Depends(get_current_user),
 ) -> Any:
     """Get current user."""
     return current_user
@@ -63,8 +68,12 @@ async def read_users_me(
 @router.put("/me", response_model=UserOut)
 async def update_user_me(
     user_update: UserUpdate,
-    current_user: User = Depends(get_current_active_user),
+    current_user: User = Depends(get_current_user),
 ) -> Any:
     """Update current user."""
+    if not user_update.model_fields_set:
+        # Nothing to change, and the current user is already loaded
+        return current_user
+    
     updated_user = await update_user(current_user.id, user_update)
     return updated_user
\ No newline at end of file
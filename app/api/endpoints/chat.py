@@ -1,7 +1,12 @@
-from typing import Any, List
+import asyncio
+from typing import Any, AsyncIterator, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Path, Query, status
+import orjson
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Path, Query, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from openai import APIError
 from prisma.models import Chat, Message, User
+from pydantic import TypeAdapter
 
 from app.schemas.chat import (
     ChatCreate,
@@ -10,7 +15,7 @@ from app.schemas.chat import (
     MessageCreate,
     MessageOut,
 )
-from app.services.auth import get_current_active_user
+from app.services.auth import fetch_user, get_current_user, get_current_user_id
 from app.services.chat import (
     add_chat_participant,
     create_chat,
@@ -19,19 +24,42 @@ from app.services.chat import (
     generate_ai_response,
     get_chat,
     get_chat_messages,
+    get_chat_record,
     get_user_chats,
-    mark_messages_as_read,
+    queue_messages_read,
     remove_chat_participant,
+    save_ai_message,
+    stream_ai_response,
     update_chat,
 )
+from app.services.openai import moderate_content
 
 router = APIRouter()
 
+# Built once and reused for every page of messages
+_messages_out = TypeAdapter(List[MessageOut])
+
+
+async def _stream_ai_response_events(chat_id: str, user_id: str) -> AsyncIterator[bytes]:
+    """Relay an AI response as server-sent events, then save it in one write."""
+    parts = []
+    try:
+        async for delta in stream_ai_response(chat_id):
+            parts.append(delta)
+            yield b"data: " + orjson.dumps({"content": delta}) + b"\n\n"
+    except APIError:
+        # The response has already started, so report the failure in-band
+        yield b"event: error\ndata: " + orjson.dumps({"detail": "AI service error"}) + b"\n\n"
+        return
+    
+    ai_message = await save_ai_message(chat_id, user_id, "".join(parts))
+    yield b"event: done\ndata: " + orjson.dumps({"id": ai_message.id}) + b"\n\n"
+
 
 @router.post("/", response_model=ChatOut)
 async def create_new_chat(
     chat_data: ChatCreate,
-    current_user: User = Depends(get_current_active_user),
+    current_user: User = Depends(get_current_user),
 ) -> Any:
     """Create a new chat."""
     chat = await create_chat(chat_data, current_user.id, chat_data.participant_ids)
@@ -40,7 +68,7 @@ async def create_new_chat(
 
 @router.get("/", response_model=List[ChatOut])
 async def read_user_chats(
-    current_user: User = Depends(get_current_active_user),
+    current_user: User = Depends(get_current_user),
 ) -> Any:
     """Get all chats for the current user."""
     chats = await get_user_chats(current_user.id)
@@ -50,10 +78,13 @@ async def read_user_chats(
 @router.get("/{chat_id}", response_model=ChatOut)
 async def read_chat(
     chat_id: str = Path(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user_id: str = Depends(get_current_user_id),
 ) -> Any:
     """Get a specific chat."""
-    chat = await get_chat(chat_id)
+    # Load the user and the chat concurrently rather than back to back
+    current_user, chat = await asyncio.gather(
+        fetch_user(current_user_id), get_chat(chat_id)
+    )
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -61,8 +92,7 @@ async def read_chat(
         )
     
     # Check if the user is a participant
-    is_participant = any(p.userId == current_user.id for p in chat.participants)
-    if not is_participant:
+    if current_user.id not in chat.participantIds:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a participant in this chat",
@@ -75,10 +105,12 @@ async def read_chat(
 async def update_existing_chat(
     chat_data: ChatUpdate,
     chat_id: str = Path(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user_id: str = Depends(get_current_user_id),
 ) -> Any:
     """Update a chat."""
-    chat = await get_chat(chat_id)
+    current_user, chat = await asyncio.gather(
+        fetch_user(current_user_id), get_chat_record(chat_id)
+    )
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -99,10 +131,12 @@ async def update_existing_chat(
 @router.delete("/{chat_id}")
 async def delete_existing_chat(
     chat_id: str = Path(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user_id: str = Depends(get_current_user_id),
 ) -> Any:
     """Delete a chat."""
-    chat = await get_chat(chat_id)
+    current_user, chat = await asyncio.gather(
+        fetch_user(current_user_id), get_chat_record(chat_id)
+    )
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -124,10 +158,12 @@ async def delete_existing_chat(
 async def add_participant(
     chat_id: str = Path(...),
     user_id: str = Query(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user_id: str = Depends(get_current_user_id),
 ) -> Any:
     """Add a participant to a chat."""
-    chat = await get_chat(chat_id)
+    current_user, chat = await asyncio.gather(
+        fetch_user(current_user_id), get_chat_record(chat_id)
+    )
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -142,8 +178,7 @@ async def add_participant(
         )
     
     # Check if user is already a participant
-    is_participant = any(p.userId == user_id for p in chat.participants)
-    if is_participant:
+    if user_id in chat.participantIds:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User is already a participant",
@@ -158,10 +193,12 @@ async def add_participant(
 async def remove_participant(
     chat_id: str = Path(...),
     user_id: str = Query(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user_id: str = Depends(get_current_user_id),
 ) -> Any:
     """Remove a participant from a chat."""
-    chat = await get_chat(chat_id)
+    current_user, chat = await asyncio.gather(
+        fetch_user(current_user_id), get_chat_record(chat_id)
+    )
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -176,8 +213,7 @@ async def remove_participant(
         )
     
     # Check if user is a participant
-    is_participant = any(p.userId == user_id for p in chat.participants)
-    if not is_participant:
+    if user_id not in chat.participantIds:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User is not a participant",
@@ -198,10 +234,15 @@ async def remove_participant(
 async def create_chat_message(
     message_data: MessageCreate,
     chat_id: str = Path(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user_id: str = Depends(get_current_user_id),
 ) -> Any:
     """Create a new message in a chat."""
-    chat = await get_chat(chat_id)
+    # Moderation is the slowest step, so overlap it with the access checks
+    current_user, chat, is_flagged = await asyncio.gather(
+        fetch_user(current_user_id),
+        get_chat_record(chat_id),
+        moderate_content(message_data.content),
+    )
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -209,26 +250,39 @@ async def create_chat_message(
         )
     
     # Check if the user is a participant
-    is_participant = any(p.userId == current_user.id for p in chat.participants)
-    if not is_participant:
+    if current_user.id not in chat.participantIds:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a participant in this chat",
         )
     
+    if is_flagged:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Message content has been flagged as inappropriate.",
+        )
+    
     message = await create_message(chat_id, current_user.id, message_data)
     return message
 
 
 @router.get("/{chat_id}/messages", response_model=List[MessageOut])
 async def read_chat_messages(
+    background_tasks: BackgroundTasks,
     chat_id: str = Path(...),
     limit: int = Query(50, ge=1, le=100),
     offset: int = Query(0, ge=0),
-    current_user: User = Depends(get_current_active_user),
+    before_id: Optional[str] = Query(None),
+    current_user_id: str = Depends(get_current_user_id),
 ) -> Any:
-    """Get messages for a chat."""
-    chat = await get_chat(chat_id)
+    """
+    Get the latest messages for a chat, oldest first.
+    Pass the ID of the oldest message received as `before_id` to page back
+    through the history.
+    """
+    current_user, chat = await asyncio.gather(
+        fetch_user(current_user_id), get_chat_record(chat_id)
+    )
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -236,28 +290,31 @@ async def read_chat_messages(
         )
     
     # Check if the user is a participant
-    is_participant = any(p.userId == current_user.id for p in chat.participants)
-    if not is_participant:
+    if current_user.id not in chat.participantIds:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a participant in this chat",
         )
     
-    messages = await get_chat_messages(chat_id, limit, offset)
-    
-    # Mark messages as read
-    await mark_messages_as_read(chat_id, current_user.id)
+    # Mark messages as read once the response has been sent
+    background_tasks.add_task(queue_messages_read, chat_id, current_user.id)
     
-    return messages
+    # Returning a response directly skips FastAPI's per-item re-validation;
+    # response_model is kept for the OpenAPI schema
+    messages = await get_chat_messages(chat_id, limit, offset, before_id=before_id)
+    items = _messages_out.validate_python(messages, from_attributes=True)
+    return ORJSONResponse(_messages_out.dump_python(items, mode="json"))
 
 
 @router.post("/{chat_id}/ai-response", response_model=MessageOut)
 async def generate_chat_ai_response(
     chat_id: str = Path(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user_id: str = Depends(get_current_user_id),
 ) -> Any:
     """Generate an AI response in a chat."""
-    chat = await get_chat(chat_id)
+    current_user, chat = await asyncio.gather(
+        fetch_user(current_user_id), get_chat_record(chat_id)
+    )
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -265,12 +322,43 @@ async def generate_chat_ai_response(
         )
     
     # Check if the user is a participant
-    is_participant = any(p.userId == current_user.id for p in chat.participants)
-    if not is_participant:
+    if current_user.id not in chat.participantIds:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a participant in this chat",
         )
     
     ai_message = await generate_ai_response(chat_id, current_user.id)
-    return ai_message
\ No newline at end of file
+    return ai_message
+
+
+@router.post("/{chat_id}/ai-response/stream")
+async def stream_chat_ai_response(
+    chat_id: str = Path(...),
+    current_user_id: str = Depends(get_current_user_id),
+) -> Any:
+    """
+    Generate an AI response in a chat, streamed as server-sent events.
+    Each event carries the next piece of text; a final `done` event carries the
+    ID of the saved message.
+    """
+    current_user, chat = await asyncio.gather(
+        fetch_user(current_user_id), get_chat_record(chat_id)
+    )
+    if not chat:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Chat with ID {chat_id} not found",
+        )
+    
+    # Check if the user is a participant
+    if current_user.id not in chat.participantIds:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not a participant in this chat",
+        )
+    
+    return StreamingResponse(
+        _stream_ai_response_events(chat_id, current_user.id),
+        media_type="text/event-stream",
+    )
\ No newline at end of file
@@ -0,0 +1,115 @@
+import logging
+from typing import Any, Optional
+
+import orjson
+from prisma.models import User
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Shared client; connections are pooled and opened lazily on first use
+redis_client = Redis.from_url(settings.REDIS_URL)
+
+# Values are dumped straight from model_dump(), so datetimes are encoded by
+# orjson natively; UTC ones get a compact "Z" suffix
+CACHE_JSON_OPTIONS = orjson.OPT_UTC_Z
+
+
+async def init_cache() -> None:
+    """Check that the cache is reachable."""
+    try:
+        await redis_client.ping()
+        logger.info("Connected to Redis")
+    except RedisError as e:
+        # The cache is only an optimization, so keep serving without it
+        logger.warning(f"Redis unavailable, continuing without cache: {str(e)}")
+
+
+async def close_cache() -> None:
+    """Close the cache connection pool."""
+    await redis_client.aclose()
+
+
+async def get_json(key: str) -> Optional[Any]:
+    """Get a cached JSON value. Returns None on a miss or if Redis is down."""
+    try:
+        cached = await redis_client.get(key)
+    except RedisError as e:
+        logger.error(f"Error reading cache key {key}: {str(e)}")
+        return None
+
+    if cached is None:
+        return None
+    return orjson.loads(cached)
+
+
+async def set_json(key: str, value: Any, ttl: int) -> None:
+    """Cache a JSON-serializable value for `ttl` seconds."""
+    try:
+        await redis_client.set(key, orjson.dumps(value, option=CACHE_JSON_OPTIONS), ex=ttl)
+    except RedisError as e:
+        logger.error(f"Error writing cache key {key}: {str(e)}")
+
+
+async def delete_keys(*keys: str) -> None:
+    """Remove keys from the cache."""
+    try:
+        await redis_client.delete(*keys)
+    except RedisError as e:
+        logger.error(f"Error deleting cache keys {keys}: {str(e)}")
+
+
+def _user_key(user_id: str) -> str:
+    return f"auth:user:{user_id}"
+
+
+def _admin_key(user_id: str) -> str:
+    return f"auth:admin:{user_id}"
+
+
+async def get_cached_user(user_id: str) -> Optional[User]:
+    """Get a user from the cache, or None on a miss."""
+    data = await get_json(_user_key(user_id))
+    if data is None:
+        return None
+    return User.model_validate(data)
+
+
+async def cache_user(user: User) -> None:
+    """Cache a user for authenticating later requests."""
+    # The password hash is never needed to authorize a request
+    data = user.model_dump(exclude={"passwordHash"})
+    await set_json(_user_key(user.id), data, ttl=settings.USER_CACHE_TTL_SECONDS)
+
+
+async def invalidate_cached_user(user_id: str) -> None:
+    """Drop a user from the cache after it has been changed or deleted."""
+    await delete_keys(_user_key(user_id), _admin_key(user_id))
+
+
+async def revoke_admin_confirmation(user_id: str) -> None:
+    """
+    Stop trusting a user's admin claim. Call it before a change that could
+    demote or delete the user: it raises RedisError if the confirmation can't
+    be removed, so the change is abandoned instead of leaving it behind.
+    """
+    await redis_client.delete(_admin_key(user_id))
+
+
+async def is_confirmed_admin(user_id: str) -> bool:
+    """
+    Check whether a user was recently confirmed to be an admin.
+    Raises RedisError instead of guessing if the cache can't be read.
+    """
+    return bool(await redis_client.exists(_admin_key(user_id)))
+
+
+async def confirm_admin(user_id: str) -> None:
+    """Record that a user's stored role is ADMIN, so their admin claim can be trusted."""
+    try:
+        await redis_client.set(_admin_key(user_id), 1, ex=settings.USER_CACHE_TTL_SECONDS)
+    except RedisError as e:
+        logger.error(f"Error confirming admin {user_id}: {str(e)}")
@@ -1,44 +1,69 @@
+import logging
+
 from fastapi import FastAPI, Request, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from jwt.exceptions import PyJWTError
-from prisma.errors import PrismaError
+from openai import APIError
+from prisma.errors import PrismaError, RecordNotFoundError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
+logger = logging.getLogger(__name__)
+
 
 def setup_exception_handlers(app: FastAPI) -> None:
-    @app.exception_handler(StarletteHTTPException)
-    async def http_exception_handler(request: Request, exc: StarletteHTTPException):
-        return JSONResponse(
-            status_code=exc.status_code,
-            content={"detail": exc.detail},
+    # Most specific handlers first. Errors we don't expect are logged in full
+    # but answered with a fixed body, so a large exception never ends up
+    # serialized into (or leaked through) the response.
+    @app.exception_handler(RecordNotFoundError)
+    async def record_not_found_handler(request: Request, exc: RecordNotFoundError):
+        return ORJSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            content={"detail": "Resource not found"},
         )
 
-    @app.exception_handler(RequestValidationError)
-    async def validation_exception_handler(request: Request, exc: RequestValidationError):
-        return JSONResponse(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            content={"detail": exc.errors()},
+    @app.exception_handler(PrismaError)
+    async def prisma_exception_handler(request: Request, exc: PrismaError):
+        logger.exception("Database error", exc_info=exc)
+        return ORJSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"detail": "Database error"},
         )
 
     @app.exception_handler(PyJWTError)
     async def jwt_exception_handler(request: Request, exc: PyJWTError):
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_401_UNAUTHORIZED,
             content={"detail": "Could not validate credentials"},
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    @app.exception_handler(PrismaError)
-    async def prisma_exception_handler(request: Request, exc: PrismaError):
-        return JSONResponse(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            content={"detail": "Database error", "error": str(exc)},
+    @app.exception_handler(APIError)
+    async def openai_exception_handler(request: Request, exc: APIError):
+        return ORJSONResponse(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            content={"detail": "AI service error"},
+        )
+
+    @app.exception_handler(RequestValidationError)
+    async def validation_exception_handler(request: Request, exc: RequestValidationError):
+        return ORJSONResponse(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            content={"detail": exc.errors()},
+        )
+
+    @app.exception_handler(StarletteHTTPException)
+    async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+        return ORJSONResponse(
+            status_code=exc.status_code,
+            content={"detail": exc.detail},
+            headers=getattr(exc, "headers", None),
         )
 
     @app.exception_handler(Exception)
     async def general_exception_handler(request: Request, exc: Exception):
-        return JSONResponse(
+        logger.exception("Unhandled error", exc_info=exc)
+        return ORJSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            content={"detail": "Internal server error", "error": str(exc)},
+            content={"detail": "Internal server error"},
         )
\ No newline at end of file
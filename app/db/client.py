@@ -0,0 +1,22 @@
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from prisma import Prisma
+
+from app.core.config import settings
+
+
+def _pooled_database_url(url: str) -> str:
+    """Add connection pool parameters to the database URL unless already set."""
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.setdefault("connection_limit", str(settings.DB_CONNECTION_LIMIT))
+    query.setdefault("pool_timeout", str(settings.DB_POOL_TIMEOUT))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+# The one Prisma client for the app. It is registered so model queries such
+# as `User.prisma()` use it, and it is connected once on startup.
+prisma_client = Prisma(
+    auto_register=True,
+    datasource={"url": _pooled_database_url(settings.DATABASE_URL)},
+)
@@ -1,12 +1,14 @@
 import logging
 from typing import Optional
 
-from prisma import Prisma
+from prisma.errors import UniqueViolationError
 from prisma.models import User
 
-logger = logging.getLogger(__name__)
+from app.db.client import prisma_client
+from app.services.auth import insert_user
+from app.services.stats import seed_stats
 
-prisma_client = Prisma()
+logger = logging.getLogger(__name__)
 
 
 async def init_db() -> None:
@@ -16,15 +18,28 @@ async def init_db() -> None:
         await prisma_client.connect()
         logger.info("Connected to the database")
         
+        # Counters must exist before anything that updates them
+        await seed_stats()
+        
         # Create default admin if none exists
         await create_default_admin()
         
+        # Fill in participant IDs for chats created before they were tracked
+        await backfill_chat_participant_ids()
+        
         logger.info("Database initialization completed")
     except Exception as e:
         logger.error(f"Database initialization failed: {str(e)}")
         raise
 
 
+async def close_db() -> None:
+    """Disconnect from the database."""
+    if prisma_client.is_connected():
+        await prisma_client.disconnect()
+        logger.info("Disconnected from the database")
+
+
 async def create_default_admin() -> Optional[User]:
     """Create a default admin user if no admin exists."""
     # Check if any admin exists
@@ -39,15 +54,38 @@ async def create_default_admin() -> Optional[User]:
     logger.info("Creating default admin user")
     
     # Create default admin
-    admin = await User.prisma().create(
-        data={
-            "email": "admin@example.com",
-            "name": "Default Admin",
-            "role": "ADMIN",
-            "authProvider": "EMAIL",
-            "passwordHash": "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW",  # "password"
-        }
-    )
+    try:
+        admin = await insert_user(
+            data={
+                "email": "admin@example.com",
+                "name": "Default Admin",
+                "role": "ADMIN",
+                "authProvider": "EMAIL",
+                "passwordHash": "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW",  # "password"
+            }
+        )
+    except UniqueViolationError:
+        # Another worker starting up at the same time created it first
+        logger.info("Admin user already exists")
+        return None
     
     logger.info(f"Default admin created with ID: {admin.id}")
-    return admin
\ No newline at end of file
+    return admin
+
+
+async def backfill_chat_participant_ids() -> int:
+    """Populate `Chat.participantIds` from the participant table where it is empty."""
+    # Every chat has at least its owner, so an empty list means it was never filled
+    count = await prisma_client.execute_raw(
+        '''
+        UPDATE "Chat" c
+        SET "participantIds" = ARRAY(
+            SELECT p."userId" FROM "ChatParticipant" p WHERE p."chatId" = c."id"
+        )
+        WHERE cardinality(c."participantIds") = 0
+        '''
+    )
+    
+    if count:
+        logger.info(f"Backfilled participant IDs for {count} chats")
+    return count
\ No newline at end of file
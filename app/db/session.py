@@ -1,13 +1,6 @@
-from prisma import Prisma
-
-# Create a Prisma client
-prisma_client = Prisma()
+from app.db.client import prisma_client
 
 
 async def get_db():
     """Get database client."""
-    try:
-        await prisma_client.connect()
-        yield prisma_client
-    finally:
-        await prisma_client.disconnect()
\ No newline at end of file
+    yield prisma_client
\ No newline at end of file
@@ -1,16 +1,22 @@
+import asyncio
+
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer
 
 from app.api.api import api_router
+from app.core.cache import close_cache, init_cache
 from app.core.config import settings
 from app.core.exceptions import setup_exception_handlers
-from app.db.init_db import init_db
+from app.db.init_db import close_db, init_db
+from app.services.chat import run_read_mark_flusher
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 # Set up CORS
@@ -39,6 +45,18 @@ app.include_router(api_router, prefix=settings.API_V1_STR)
 async def startup_event():
     """Initialize database and other startup tasks."""
     await init_db()
+    await init_cache()
+    
+    # Apply queued read marks in batches
+    app.state.read_mark_flusher = asyncio.create_task(run_read_mark_flusher())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release connections held by the app."""
+    app.state.read_mark_flusher.cancel()
+    await close_cache()
+    await close_db()
 
 
 @app.get("/")
@@ -50,4 +68,16 @@ async def root():
 if __name__ == "__main__":
     import uvicorn
     
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    if settings.WORKERS > 1 and "SECRET_KEY" not in settings.model_fields_set:
+        raise SystemExit("SECRET_KEY must be configured to run more than one worker")
+    
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        # The reloader can only supervise a single worker
+        workers=1 if settings.RELOAD else settings.WORKERS,
+        reload=settings.RELOAD,
+    )
\ No newline at end of file
@@ -1,7 +1,8 @@
 from datetime import datetime
 from typing import List, Optional
 
-from pydantic import BaseModel
+from prisma.models import Chat
+from pydantic import BaseModel, ConfigDict, Field
 
 from app.schemas.user import UserOut
 
@@ -16,12 +17,12 @@ class ChatParticipantCreate(ChatParticipantBase):
 
 class ChatParticipantOut(ChatParticipantBase):
     id: str
-    chat_id: str
-    joined_at: datetime
+    user_id: str = Field(validation_alias="userId")
+    chat_id: str = Field(validation_alias="chatId")
+    joined_at: datetime = Field(validation_alias="joinedAt")
     user: UserOut
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True, populate_by_name=True)
 
 
 class ChatBase(BaseModel):
@@ -41,14 +42,14 @@ class ChatUpdate(BaseModel):
 
 class ChatOut(ChatBase):
     id: str
-    owner_id: str
-    created_at: datetime
-    updated_at: datetime
-    participants: List[ChatParticipantOut]
+    is_group: bool = Field(False, validation_alias="isGroup")
+    owner_id: str = Field(validation_alias="ownerId")
+    created_at: datetime = Field(validation_alias="createdAt")
+    updated_at: datetime = Field(validation_alias="updatedAt")
+    participants: Optional[List[ChatParticipantOut]] = None  # when not loaded
     owner: Optional[UserOut] = None
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True, populate_by_name=True)
 
 
 class MessageBase(BaseModel):
@@ -61,13 +62,17 @@ class MessageCreate(MessageBase):
 
 class MessageOut(MessageBase):
     id: str
-    chat_id: str
-    user_id: str
-    is_ai: bool
-    is_read: bool
-    created_at: datetime
-    updated_at: datetime
-    user: UserOut
+    chat_id: str = Field(validation_alias="chatId")
+    user_id: str = Field(validation_alias="userId")
+    is_ai: bool = Field(validation_alias="isAI")
+    is_read: bool = Field(validation_alias="isRead")
+    created_at: datetime = Field(validation_alias="createdAt")
+    updated_at: datetime = Field(validation_alias="updatedAt")
+    user: Optional[UserOut] = None  # when not loaded
+
+    model_config = ConfigDict(from_attributes=True, populate_by_name=True)
+
 
-    class Config:
-        orm_mode = True
\ No newline at end of file
+class ChatPage(BaseModel):
+    items: List[Chat]
+    next_cursor: Optional[str] = None
\ No newline at end of file
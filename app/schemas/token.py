@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -8,4 +10,6 @@ class Token(BaseModel):
 
 class TokenPayload(BaseModel):
     sub: str = None
-    exp: int = None
\ No newline at end of file
+    exp: int = None
+    iat: Optional[int] = None
+    role: Optional[str] = None
\ No newline at end of file
@@ -1,6 +1,7 @@
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional
 
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
 
 
 class UserBase(BaseModel):
@@ -24,8 +25,13 @@ class UserUpdate(BaseModel):
 class UserOut(UserBase):
     id: str
     role: str
-    auth_provider: str
-    created_at: str
+    # Read from the Prisma model's camelCase fields, returned in snake_case
+    auth_provider: str = Field(validation_alias="authProvider")
+    created_at: datetime = Field(validation_alias="createdAt")
 
-    class Config:
-        orm_mode = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True, populate_by_name=True)
+
+
+class UserPage(BaseModel):
+    items: List[UserOut]
+    next_cursor: Optional[str] = None
\ No newline at end of file
@@ -1,81 +1,325 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Any, Dict, Optional, Union
 
+import bcrypt
 import jwt
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jwt.exceptions import InvalidTokenError
-from passlib.context import CryptContext
-from prisma.models import User
+from jwt.exceptions import DecodeError, ExpiredSignatureError, InvalidTokenError
+from prisma.errors import PrismaError
+from prisma.models import Chat, ChatParticipant, Message, User
 from pydantic import EmailStr
+from redis.exceptions import RedisError
 
+from app.core.cache import (
+    cache_user,
+    confirm_admin,
+    delete_keys,
+    get_cached_user,
+    invalidate_cached_user,
+    is_confirmed_admin,
+    revoke_admin_confirmation,
+)
 from app.core.config import settings
+from app.db.client import prisma_client
+from app.schemas.token import TokenPayload
 from app.schemas.user import UserCreate, UserUpdate
+from app.services.chat import CONTEXT_WINDOW_KEY
+from app.services.stats import increment_stats
+
+logger = logging.getLogger(__name__)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/auth/login")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt is deliberately slow CPU work, so it runs off the event loop. A
+# dedicated pool bounds how many hashes run at once during a login flood.
+_hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="bcrypt")
 
 ALGORITHM = "HS256"
 
+# Token settings are built once instead of on every request
+_JWT_KEY = settings.SECRET_KEY.encode()
+_JWT_ALGORITHMS = [ALGORITHM]
+_JWT_DECODE_OPTIONS = {"require": ["exp", "sub"], "verify_aud": False}
+_jwt = jwt.PyJWT()
+
+# Per-process caches in front of token verification and the user lookup.
+# The short TTL bounds how long a change made through another worker can
+# go unnoticed here.
+_token_cache: TTLCache = TTLCache(maxsize=10000, ttl=settings.AUTH_CACHE_TTL_SECONDS)
+_user_cache: TTLCache = TTLCache(maxsize=10000, ttl=settings.AUTH_CACHE_TTL_SECONDS)
+
+# Negative caches so floods of bad tokens, or tokens of deleted users, are
+# turned away without verifying or looking anything up. Only failures that
+# are final are cached: a malformed or forged token, or an expired one, can
+# never become valid, and user IDs are never reused. A claim check such as an
+# `iat` slightly in the future (clock skew) can pass on a later try.
+_bad_token_cache: TTLCache = TTLCache(maxsize=50000, ttl=60)
+_unknown_user_cache: TTLCache = TTLCache(maxsize=50000, ttl=60)
 
-def create_access_token(subject: Union[str, Any], expires_delta: Optional[timedelta] = None) -> str:
-    """Create access token for user authentication."""
+
+def create_access_token(
+    subject: Union[str, Any],
+    expires_delta: Optional[timedelta] = None,
+    role: Optional[str] = None,
+) -> str:
+    """
+    Create access token for user authentication.
+    The user's role is embedded so admin checks can be made from the token alone.
+    """
+    now = datetime.utcnow()
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expire = now + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+        expire = now + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     
-    to_encode = {"exp": expire, "sub": str(subject)}
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=ALGORITHM)
+    to_encode = {"exp": expire, "iat": now, "sub": str(subject)}
+    if role:
+        to_encode["role"] = role
+    encoded_jwt = _jwt.encode(to_encode, _JWT_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
-    """Get the current authenticated user."""
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+async def get_token_payload(token: str = Depends(oauth2_scheme)) -> TokenPayload:
+    """Verify the access token and get its claims, without a DB lookup."""
+    token_key = hashlib.sha256(token.encode()).digest()
+    if settings.AUTH_CACHE_ENABLED:
+        if token_key in _bad_token_cache:
+            raise _credentials_exception()
+        payload = _token_cache.get(token_key)
+        # The cache entry must never outlive the token itself
+        if payload is not None and payload.exp > time.time():
+            return payload
     
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
+        payload = TokenPayload.model_validate(
+            _jwt.decode(token, _JWT_KEY, algorithms=_JWT_ALGORITHMS, options=_JWT_DECODE_OPTIONS)
+        )
+    except (DecodeError, ExpiredSignatureError):
+        # DecodeError covers bad signatures (InvalidSignatureError) as well
+        if settings.AUTH_CACHE_ENABLED:
+            _bad_token_cache[token_key] = True
+        raise _credentials_exception()
     except InvalidTokenError:
-        raise credentials_exception
+        raise _credentials_exception()
+    
+    if payload.sub is None:
+        raise _credentials_exception()
+    
+    if settings.AUTH_CACHE_ENABLED:
+        _token_cache[token_key] = payload
+    return payload
+
+
+async def get_current_user_id(payload: TokenPayload = Depends(get_token_payload)) -> str:
+    """Get the ID of the authenticated user from the access token, without a DB lookup."""
+    return payload.sub
+
+
+async def fetch_user(user_id: str) -> User:
+    """
+    Load the user an access token was issued to.
+    Kept separate from the dependency so handlers can await it concurrently
+    with their own lookups.
+    """
+    if settings.AUTH_CACHE_ENABLED:
+        if user_id in _unknown_user_cache:
+            raise _credentials_exception()
+        user = _user_cache.get(user_id)
+        if user is not None:
+            return user
     
-    user = await User.prisma().find_unique(where={"id": user_id})
+    user = await get_cached_user(user_id)
     if user is None:
-        raise credentials_exception
+        user = await User.prisma().find_unique(where={"id": user_id})
+        if user is None:
+            if settings.AUTH_CACHE_ENABLED:
+                _unknown_user_cache[user_id] = True
+            raise _credentials_exception()
+        await cache_user(user)
     
+    if settings.AUTH_CACHE_ENABLED:
+        _user_cache[user_id] = user
     return user
 
 
-async def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
-    """Check if the current user is active."""
-    return current_user
+async def forget_user(user_id: str) -> None:
+    """
+    Drop a user from every auth cache after it has been changed or deleted.
+    Best effort: changes that could demote the user must first call
+    `revoke_admin_confirmation`, which fails loudly.
+    """
+    _user_cache.pop(user_id, None)
+    await invalidate_cached_user(user_id)
+
+
+async def get_current_user(user_id: str = Depends(get_current_user_id)) -> User:
+    """Get the current authenticated user."""
+    return await fetch_user(user_id)
 
 
-async def get_current_admin_user(current_user: User = Depends(get_current_user)) -> User:
+async def get_current_admin_user(payload: TokenPayload = Depends(get_token_payload)) -> TokenPayload:
     """Check if the current user is an admin."""
-    if current_user.role != "ADMIN":
+    # Trust an admin claim only while the cache confirms the stored role. Any
+    # change to the user drops the confirmation, and so does eviction.
+    if payload.role == "ADMIN":
+        try:
+            if await is_confirmed_admin(payload.sub):
+                return payload
+        except RedisError as e:
+            logger.error(f"Error checking admin confirmation, checking the stored role: {str(e)}")
+    
+    # Read the role from the database rather than any cached copy of the user
+    user = await User.prisma().find_unique(where={"id": payload.sub})
+    if user is None:
+        raise _credentials_exception()
+    if user.role != "ADMIN":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="The user doesn't have enough privileges",
         )
-    return current_user
+    
+    if payload.role == "ADMIN":
+        await confirm_admin(user.id)
+    return payload
+
+
+# Marks hashes of the SHA-256 pre-hashed password. bcrypt only reads the first
+# 72 bytes of its input, so a fixed 64-character hex digest keeps every byte of
+# long passwords significant. Hashes without the marker are legacy hashes of
+# the raw password; `authenticate_user` upgrades them when it verifies one.
+PREHASH_PREFIX = "sha256$"
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
+
+def _prehash(password: str) -> bytes:
+    return hashlib.sha256(password.encode()).hexdigest().encode()
+
+
+def _hash_password(password: str) -> str:
+    salt = bcrypt.gensalt(rounds=settings.BCRYPT_COST)
+    return PREHASH_PREFIX + bcrypt.hashpw(_prehash(password), salt).decode()
+
+
+def _check_password(plain_password: str, hashed_password: str) -> bool:
+    if hashed_password.startswith(PREHASH_PREFIX):
+        secret = _prehash(plain_password)
+        hashed_password = hashed_password[len(PREHASH_PREFIX):]
+    else:
+        # Legacy hashes were made by passlib, which silently used only the
+        # first 72 bytes; newer bcrypt releases reject longer input instead
+        secret = plain_password.encode()[:BCRYPT_MAX_PASSWORD_BYTES]
+    
+    # The secret is within bcrypt's limit, so a ValueError can only mean the
+    # stored value is not a bcrypt hash
+    try:
+        return bcrypt.checkpw(secret, hashed_password.encode())
+    except ValueError:
+        return False
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """Check whether a stored hash predates the current hashing scheme."""
+    return not hashed_password.startswith(PREHASH_PREFIX)
 
 
 async def get_password_hash(password: str) -> str:
     """Hash a password for storing."""
-    return pwd_context.hash(password)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, _hash_password, password)
 
 
 async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a stored password against a provided password."""
-    return pwd_context.verify(plain_password, hashed_password)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _hash_executor, _check_password, plain_password, hashed_password
+    )
+
+
+async def insert_user(data: Dict[str, Any]) -> User:
+    """Create a user row and count it in the running totals."""
+    async with prisma_client.tx() as transaction:
+        user = await User.prisma(transaction).create(data=data)
+        await increment_stats(transaction, users=1)
+    return user
+
+
+async def delete_user_account(user_id: str) -> Optional[User]:
+    """
+    Delete a user, along with the chats they own and every message that
+    cascades with them, and subtract them from the running totals.
+    Returns None if the user does not exist.
+    """
+    # Messages removed by the cascade: the user's own, and any in chats they own
+    cascaded_messages = {"OR": [{"userId": user_id}, {"chat": {"is": {"ownerId": user_id}}}]}
+    
+    # Revoked up front so a Redis failure aborts the deletion cleanly
+    await revoke_admin_confirmation(user_id)
+    
+    async with prisma_client.tx() as transaction:
+        # Lock the user, then their chats, before counting. Inserts referencing
+        # either take a key-share lock on them, so nothing the cascade removes
+        # can be committed between the counts and the delete.
+        await transaction.query_raw(
+            'SELECT "id" FROM "User" WHERE "id" = $1 FOR UPDATE', user_id
+        )
+        owned = await transaction.query_raw(
+            'SELECT "id" FROM "Chat" WHERE "ownerId" = $1 FOR UPDATE', user_id
+        )
+        # Their messages may also sit in the cached context window of any
+        # chat they took part in
+        participations = await ChatParticipant.prisma(transaction).find_many(
+            where={"userId": user_id}
+        )
+        chat_ids = {row["id"] for row in owned} | {p.chatId for p in participations}
+        
+        owned_chats = await Chat.prisma(transaction).count(where={"ownerId": user_id})
+        messages = await Message.prisma(transaction).count(where=cascaded_messages)
+        ai_messages = await Message.prisma(transaction).count(
+            where={"AND": [cascaded_messages, {"isAI": True}]}
+        )
+        
+        # The cascade removes their ChatParticipant rows, so drop them from the
+        # denormalized member lists first, while those rows still select the
+        # affected chats through the (userId, chatId) index
+        await transaction.execute_raw(
+            'UPDATE "Chat" SET "participantIds" = array_remove("participantIds", $1) '
+            'WHERE "id" IN (SELECT "chatId" FROM "ChatParticipant" WHERE "userId" = $1)',
+            user_id,
+        )
+        
+        user = await User.prisma(transaction).delete(where={"id": user_id})
+        if user:
+            await increment_stats(
+                transaction,
+                users=-1,
+                chats=-owned_chats,
+                messages=-messages,
+                ai_messages=-ai_messages,
+            )
+    
+    await forget_user(user_id)
+    if user and chat_ids:
+        await delete_keys(
+            *(CONTEXT_WINDOW_KEY.format(chat_id=chat_id) for chat_id in chat_ids)
+        )
+    return user
 
 
 async def authenticate_user(email: str, password: str) -> Optional[User]:
@@ -90,6 +334,15 @@ async def authenticate_user(email: str, password: str) -> Optional[User]:
     if not stored_password_hash or not await verify_password(password, stored_password_hash):
         return None
     
+    # The plain password is only available here, so upgrade legacy hashes now
+    if password_needs_rehash(stored_password_hash):
+        user = await User.prisma().update(
+            where={"id": user.id},
+            data={"passwordHash": await get_password_hash(password)},
+        )
+        # The per-process cache would otherwise keep serving the old row
+        await forget_user(user.id)
+    
     return user
 
 
@@ -126,10 +379,11 @@ async def authenticate_google_user(token: str) -> User:
                         "authProviderId": google_id
                     }
                 )
+                await forget_user(user.id)
         
         # If user still doesn't exist, create a new one
         if not user:
-            user = await User.prisma().create(
+            user = await insert_user(
                 data={
                     "email": email,
                     "name": name,
@@ -141,9 +395,8 @@ async def authenticate_google_user(token: str) -> User:
         
         return user
     
-    except Exception as e:
-        # Log the error
-        print(f"Google authentication error: {str(e)}")
+    except PrismaError:
+        logger.exception("Google authentication error")
         return None
 
 
@@ -180,10 +433,11 @@ async def authenticate_apple_user(token: str) -> User:
                         "authProviderId": apple_id
                     }
                 )
+                await forget_user(user.id)
         
         # If user still doesn't exist, create a new one
         if not user:
-            user = await User.prisma().create(
+            user = await insert_user(
                 data={
                     "email": email,
                     "name": name,
@@ -195,9 +449,8 @@ async def authenticate_apple_user(token: str) -> User:
         
         return user
     
-    except Exception as e:
-        # Log the error
-        print(f"Apple authentication error: {str(e)}")
+    except PrismaError:
+        logger.exception("Apple authentication error")
         return None
 
 
@@ -212,7 +465,7 @@ async def register_email_user(email: str, password: str, name: Optional[str] = N
     hashed_password = await get_password_hash(password)
     
     # Create user
-    user = await User.prisma().create(
+    user = await insert_user(
         data={
             "email": email,
             "name": name,
@@ -232,7 +485,7 @@ async def create_user(user_data: UserCreate) -> User:
     if user_data.auth_provider == "EMAIL" and user_data.password:
         password_hash = await get_password_hash(user_data.password)
     
-    user = await User.prisma().create(data={
+    user = await insert_user(data={
         "email": user_data.email,
         "name": user_data.name,
         "authProvider": user_data.auth_provider,
@@ -245,15 +498,22 @@ async def create_user(user_data: UserCreate) -> User:
 
 async def update_user(user_id: str, user_data: UserUpdate) -> User:
     """Update an existing user."""
-    update_data = user_data.dict(exclude_unset=True)
+    update_data = user_data.model_dump(exclude_unset=True)
     
     if not update_data:
-        # No fields to update
-        user = await User.prisma().find_unique(where={"id": user_id})
+        # No fields to update, so any cached copy is still current
+        user = _user_cache.get(user_id) or await get_cached_user(user_id)
+        if user is None:
+            user = await User.prisma().find_unique(where={"id": user_id})
         return user
     
+    if "role" in update_data:
+        # Revoked up front so a Redis failure aborts the change cleanly
+        await revoke_admin_confirmation(user_id)
+    
     user = await User.prisma().update(
         where={"id": user_id},
         data=update_data,
     )
+    await forget_user(user_id)
     return user
\ No newline at end of file
@@ -1,10 +1,48 @@
-from typing import List, Optional
+import asyncio
+import logging
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Optional, Set
 
+import orjson
+from prisma.errors import PrismaError
 from prisma.models import Chat, ChatParticipant, Message, User
+from redis.exceptions import RedisError, WatchError
 
+from app.core.cache import delete_keys, redis_client
+from app.core.config import settings
+from app.db.client import prisma_client
 from app.schemas.chat import ChatCreate, ChatUpdate, MessageCreate
 from app.services.openai import Message as OpenAIMessage
-from app.services.openai import generate_chat_response, moderate_content
+from app.services.openai import generate_chat_response, generate_chat_response_stream
+from app.services.stats import increment_stats
+
+logger = logging.getLogger(__name__)
+
+# Set of "{chat_id}:{user_id}" read marks waiting to be applied
+READ_MARKS_KEY = "read_marks:pending"
+
+# Per-chat list of the latest messages, formatted as AI context. It lives in
+# Redis rather than in process so every worker appends to the same window.
+CONTEXT_WINDOW_KEY = "chat:context:{chat_id}"
+# Bumped by every append, so a rebuild can tell that it raced one
+CONTEXT_VERSION_KEY = "chat:context:{chat_id}:version"
+
+SYSTEM_MSG = OpenAIMessage(
+    role="system",
+    content="You are a helpful assistant in a chat conversation. Provide concise, helpful responses."
+)
+
+# Relations loaded with a chat. The query engine resolves each include level
+# with a single batched `IN (...)` query, so this costs one query per level
+# regardless of how many chats are returned. Keep every chat read on the same
+# shape so the loads stay predictable.
+CHAT_INCLUDE = {
+    "participants": {
+        "include": {
+            "user": True
+        }
+    }
+}
 
 
 async def create_chat(
@@ -13,34 +51,30 @@ async def create_chat(
     participant_ids: Optional[List[str]] = None
 ) -> Chat:
     """Create a new chat."""
-    # Create the chat
-    chat = await Chat.prisma().create(
-        data={
-            "title": chat_data.title,
-            "description": chat_data.description,
-            "isGroup": chat_data.is_group,
-            "ownerId": owner_id,
-        }
-    )
+    # The owner is always a participant; skip duplicates of them and others
+    member_ids = [owner_id] + [
+        user_id for user_id in dict.fromkeys(participant_ids or []) if user_id != owner_id
+    ]
     
-    # Add the owner as a participant
-    await ChatParticipant.prisma().create(
-        data={
-            "chatId": chat.id,
-            "userId": owner_id,
-        }
-    )
-    
-    # Add other participants if provided
-    if participant_ids:
-        for user_id in participant_ids:
-            if user_id != owner_id:  # Skip owner as they're already added
-                await ChatParticipant.prisma().create(
-                    data={
-                        "chatId": chat.id,
-                        "userId": user_id,
-                    }
-                )
+    async with prisma_client.tx() as transaction:
+        # Create the chat
+        chat = await Chat.prisma(transaction).create(
+            data={
+                "title": chat_data.title,
+                "description": chat_data.description,
+                "isGroup": chat_data.is_group,
+                "ownerId": owner_id,
+                "participantIds": member_ids,
+            }
+        )
+        
+        # Add the owner and any other participants in a single insert
+        await ChatParticipant.prisma(transaction).create_many(
+            data=[{"chatId": chat.id, "userId": user_id} for user_id in member_ids],
+            skip_duplicates=True,
+        )
+        
+        await increment_stats(transaction, chats=1)
     
     return chat
 
@@ -49,23 +83,27 @@ async def get_chat(chat_id: str) -> Optional[Chat]:
     """Get a chat by ID."""
     chat = await Chat.prisma().find_unique(
         where={"id": chat_id},
-        include={
-            "participants": {
-                "include": {
-                    "user": True
-                }
-            }
-        }
+        include=CHAT_INCLUDE,
     )
     return chat
 
 
+async def get_chat_record(chat_id: str) -> Optional[Chat]:
+    """
+    Get a chat by ID without loading its relations.
+    Use `chat.participantIds` to authorize access to it.
+    """
+    chat = await Chat.prisma().find_unique(where={"id": chat_id})
+    return chat
+
+
 async def update_chat(chat_id: str, chat_data: ChatUpdate) -> Optional[Chat]:
     """Update a chat."""
-    update_data = chat_data.dict(exclude_unset=True)
+    update_data = chat_data.model_dump(exclude_unset=True)
     
     if not update_data:
-        # No fields to update
+        # No fields to update. Chats aren't cached, so this still reads the chat,
+        # with its participants, to return the current state.
         chat = await get_chat(chat_id)
         return chat
     
@@ -78,40 +116,74 @@ async def update_chat(chat_id: str, chat_data: ChatUpdate) -> Optional[Chat]:
 
 async def delete_chat(chat_id: str) -> bool:
     """Delete a chat."""
-    await Chat.prisma().delete(where={"id": chat_id})
+    async with prisma_client.tx() as transaction:
+        # New messages take a key-share lock on their chat, so locking the chat
+        # first waits out in-flight inserts and holds off new ones. The counts
+        # below then match exactly what the cascade removes.
+        await transaction.query_raw(
+            'SELECT "id" FROM "Chat" WHERE "id" = $1 FOR UPDATE', chat_id
+        )
+        
+        # Messages are removed with the chat by the cascade
+        messages = await Message.prisma(transaction).count(where={"chatId": chat_id})
+        ai_messages = await Message.prisma(transaction).count(
+            where={"chatId": chat_id, "isAI": True}
+        )
+        
+        chat = await Chat.prisma(transaction).delete(where={"id": chat_id})
+        if chat:
+            await increment_stats(
+                transaction, chats=-1, messages=-messages, ai_messages=-ai_messages
+            )
+    
+    if chat:
+        await delete_keys(CONTEXT_WINDOW_KEY.format(chat_id=chat_id))
     return True
 
 
 async def get_user_chats(user_id: str) -> List[Chat]:
     """Get all chats for a user."""
-    chat_participants = await ChatParticipant.prisma().find_many(
-        where={"userId": user_id},
-        include={"chat": True}
+    # Filtering through the relation lets Postgres resolve membership with a
+    # semi-join on the (userId, chatId) index in a single query
+    chats = await Chat.prisma().find_many(
+        where={"participants": {"some": {"userId": user_id}}}
     )
-    return [cp.chat for cp in chat_participants]
+    return chats
 
 
 async def add_chat_participant(chat_id: str, user_id: str) -> ChatParticipant:
     """Add a user to a chat."""
-    participant = await ChatParticipant.prisma().create(
-        data={
-            "chatId": chat_id,
-            "userId": user_id,
-        }
-    )
+    async with prisma_client.tx() as transaction:
+        participant = await ChatParticipant.prisma(transaction).create(
+            data={
+                "chatId": chat_id,
+                "userId": user_id,
+            }
+        )
+        await Chat.prisma(transaction).update(
+            where={"id": chat_id},
+            data={"participantIds": {"push": user_id}},
+        )
     return participant
 
 
 async def remove_chat_participant(chat_id: str, user_id: str) -> bool:
     """Remove a user from a chat."""
-    await ChatParticipant.prisma().delete(
-        where={
-            "chatId_userId": {
-                "chatId": chat_id,
-                "userId": user_id,
+    async with prisma_client.tx() as transaction:
+        await ChatParticipant.prisma(transaction).delete(
+            where={
+                "chatId_userId": {
+                    "chatId": chat_id,
+                    "userId": user_id,
+                }
             }
-        }
-    )
+        )
+        # Prisma has no list "remove" operation; array_remove is atomic
+        await transaction.execute_raw(
+            'UPDATE "Chat" SET "participantIds" = array_remove("participantIds", $1) WHERE "id" = $2',
+            user_id,
+            chat_id,
+        )
     return True
 
 
@@ -120,20 +192,22 @@ async def create_message(
     user_id: str, 
     message_data: MessageCreate
 ) -> Message:
-    """Create a new message in a chat."""
-    # Check if content is appropriate
-    is_flagged = await moderate_content(message_data.content)
-    if is_flagged:
-        raise ValueError("Message content has been flagged as inappropriate.")
-    
-    message = await Message.prisma().create(
-        data={
-            "content": message_data.content,
-            "chatId": chat_id,
-            "userId": user_id,
-            "isAI": False,
-        }
-    )
+    """
+    Create a new message in a chat.
+    The content should already have passed `moderate_content`.
+    """
+    async with prisma_client.tx() as transaction:
+        message = await Message.prisma(transaction).create(
+            data={
+                "content": message_data.content,
+                "chatId": chat_id,
+                "userId": user_id,
+                "isAI": False,
+            }
+        )
+        await increment_stats(transaction, messages=1)
+    
+    await append_to_context_window(chat_id, message)
     
     # Generate AI response if requested
     if message_data.generate_ai_response:
@@ -142,21 +216,33 @@ async def create_message(
     return message
 
 
-async def get_chat_messages(chat_id: str, limit: int = 50, offset: int = 0) -> List[Message]:
-    """Get messages for a chat."""
+async def get_chat_messages(
+    chat_id: str,
+    limit: int = 50,
+    offset: int = 0,
+    before_id: Optional[str] = None,
+) -> List[Message]:
+    """
+    Get the `limit` latest messages for a chat, in chronological order.
+    Pass `before_id` to get the messages that precede that message instead.
+    """
+    # A negative take reads backwards from the end of the ascending order, so
+    # the page comes back already in chronological order
+    page_args = {"cursor": {"id": before_id}, "skip": offset + 1} if before_id else {"skip": offset}
     messages = await Message.prisma().find_many(
         where={"chatId": chat_id},
         include={"user": True},
-        order_by=[{"createdAt": "desc"}],
-        take=limit,
-        skip=offset,
+        order_by=[{"createdAt": "asc"}, {"id": "asc"}],
+        take=-limit,
+        **page_args,
     )
-    return list(reversed(messages))  # Return in chronological order
+    return messages
 
 
 async def mark_messages_as_read(chat_id: str, user_id: str) -> int:
     """Mark all unread messages in a chat as read for a user."""
     # This is a simplified version. In a real app, you'd want to track read status per user
+    # update_many returns the number of rows updated
     result = await Message.prisma().update_many(
         where={
             "chatId": chat_id,
@@ -165,37 +251,190 @@ async def mark_messages_as_read(chat_id: str, user_id: str) -> int:
         },
         data={"isRead": True},
     )
-    return result.count
+    return result
 
 
-async def generate_ai_response(chat_id: str, user_id: str) -> Message:
-    """Generate an AI response to the latest messages in a chat."""
-    # Get recent messages to build context
-    recent_messages = await get_chat_messages(chat_id, limit=10)
+async def queue_messages_read(chat_id: str, user_id: str) -> None:
+    """
+    Queue a chat's messages to be marked as read for a user.
+    Repeated reads between flushes collapse into a single mark.
+    """
+    try:
+        await redis_client.sadd(READ_MARKS_KEY, f"{chat_id}:{user_id}")
+    except RedisError as e:
+        logger.error(f"Error queueing read mark, applying it directly: {str(e)}")
+        await mark_messages_as_read(chat_id, user_id)
+
+
+async def flush_read_marks(batch_size: int = 1000) -> int:
+    """Apply queued read marks with one update per chat. Returns the number of chats updated."""
+    # SPOP removes the marks atomically, so concurrent flushers (one per
+    # worker process) never apply the same mark twice
+    pending = await redis_client.spop(READ_MARKS_KEY, batch_size)
+    if not pending:
+        return 0
+    
+    readers_by_chat: Dict[str, Set[str]] = defaultdict(set)
+    for mark in pending:
+        chat_id, user_id = mark.decode().split(":", 1)
+        readers_by_chat[chat_id].add(user_id)
+    
+    unapplied: List[str] = []
+    error: Optional[PrismaError] = None
+    for chat_id, readers in readers_by_chat.items():
+        where = {"chatId": chat_id, "isRead": False}
+        # isRead is shared by all readers. Once two different users have read
+        # the chat, every message has been read by someone other than its author.
+        if len(readers) == 1:
+            where["userId"] = {"not": next(iter(readers))}
+        try:
+            await Message.prisma().update_many(where=where, data={"isRead": True})
+        except PrismaError as e:
+            error = e
+            unapplied.extend(f"{chat_id}:{user_id}" for user_id in readers)
+    
+    if error is not None:
+        # The marks were already popped; queue the failed ones again so the
+        # next flush retries them
+        await redis_client.sadd(READ_MARKS_KEY, *unapplied)
+        raise error
+    
+    return len(readers_by_chat)
+
+
+async def run_read_mark_flusher() -> None:
+    """Flush queued read marks periodically until cancelled."""
+    delay = settings.READ_MARKS_FLUSH_INTERVAL_SECONDS
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            await flush_read_marks()
+        except (PrismaError, RedisError) as e:
+            # Back off while the database or Redis is down, instead of failing
+            # (and logging) twice a second in every worker
+            delay = min(delay * 2, settings.READ_MARKS_MAX_BACKOFF_SECONDS)
+            logger.error(f"Error flushing read marks, retrying in {delay:g}s: {str(e)}")
+        else:
+            delay = settings.READ_MARKS_FLUSH_INTERVAL_SECONDS
+
+
+def _to_openai_message(message: Message) -> OpenAIMessage:
+    role = "assistant" if message.isAI else "user"
+    return OpenAIMessage(role=role, content=message.content)
+
+
+def _context_item(message: Message) -> bytes:
+    return orjson.dumps({"id": message.id, **_to_openai_message(message).model_dump()})
+
+
+def _window_from_items(items: List[bytes]) -> List[OpenAIMessage]:
+    """Decode a cached window. An append that raced a rebuild can repeat a message."""
+    seen: Set[str] = set()
+    window = []
+    for item in items:
+        data = orjson.loads(item)
+        if data["id"] not in seen:
+            seen.add(data["id"])
+            window.append(OpenAIMessage(role=data["role"], content=data["content"]))
+    return window[-settings.AI_CONTEXT_MESSAGES:]
+
+
+async def _recent_messages(chat_id: str) -> List[Message]:
+    return await get_chat_messages(chat_id, limit=settings.AI_CONTEXT_MESSAGES)
+
+
+async def get_context_window(chat_id: str) -> List[OpenAIMessage]:
+    """Get the latest messages of a chat formatted for OpenAI, oldest first."""
+    key = CONTEXT_WINDOW_KEY.format(chat_id=chat_id)
+    version_key = CONTEXT_VERSION_KEY.format(chat_id=chat_id)
+    try:
+        cached = await redis_client.lrange(key, 0, -1)
+    except RedisError as e:
+        logger.error(f"Error reading context window, loading it from the database: {str(e)}")
+        return [_to_openai_message(msg) for msg in await _recent_messages(chat_id)]
+    
+    if cached:
+        return _window_from_items(cached)
     
-    # Format messages for OpenAI
-    formatted_messages = []
-    for msg in recent_messages:
-        role = "assistant" if msg.isAI else "user"
-        formatted_messages.append(OpenAIMessage(role=role, content=msg.content))
+    recent_messages = None
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            # An append between here and EXEC would be missing from what we
+            # load, and its RPUSHX would find no window to add to. Watching the
+            # version makes the rebuild abort instead.
+            await pipe.watch(version_key)
+            recent_messages = await _recent_messages(chat_id)
+            if recent_messages:
+                pipe.multi()
+                pipe.delete(key)
+                pipe.rpush(key, *(_context_item(msg) for msg in recent_messages))
+                pipe.expire(key, settings.AI_CONTEXT_TTL_SECONDS)
+                await pipe.execute()
+    except WatchError:
+        # Leave the window to be rebuilt on next use
+        pass
+    except RedisError as e:
+        logger.error(f"Error caching context window: {str(e)}")
     
-    # Add a system message
-    formatted_messages.insert(0, OpenAIMessage(
-        role="system",
-        content="You are a helpful assistant in a chat conversation. Provide concise, helpful responses."
-    ))
+    if recent_messages is None:
+        recent_messages = await _recent_messages(chat_id)
+    return [_to_openai_message(msg) for msg in recent_messages]
+
+
+async def append_to_context_window(chat_id: str, message: Message) -> None:
+    """Add a new message to a chat's context window, if it is cached."""
+    key = CONTEXT_WINDOW_KEY.format(chat_id=chat_id)
+    version_key = CONTEXT_VERSION_KEY.format(chat_id=chat_id)
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.incr(version_key)
+            pipe.expire(version_key, settings.AI_CONTEXT_TTL_SECONDS)
+            # RPUSHX leaves a missing window alone, to be loaded in full on next use
+            pipe.rpushx(key, _context_item(message))
+            pipe.ltrim(key, -settings.AI_CONTEXT_MESSAGES, -1)
+            await pipe.execute()
+    except RedisError as e:
+        # A window that misses this message would be stale, so drop it
+        logger.error(f"Error appending to context window: {str(e)}")
+        await delete_keys(key)
+
+
+async def save_ai_message(chat_id: str, user_id: str, content: str) -> Message:
+    """Save an AI response to a chat."""
+    async with prisma_client.tx() as transaction:
+        ai_message = await Message.prisma(transaction).create(
+            data={
+                "content": content,
+                "chatId": chat_id,
+                "userId": user_id,  # Using the same user ID for simplicity
+                "isAI": True,
+            }
+        )
+        await increment_stats(transaction, messages=1, ai_messages=1)
+    
+    await append_to_context_window(chat_id, ai_message)
+    return ai_message
+
+
+async def generate_ai_response(chat_id: str, user_id: str) -> Message:
+    """Generate an AI response to the latest messages in a chat."""
+    # Recent messages as context, after the system message
+    context = await get_context_window(chat_id)
+    formatted_messages = [SYSTEM_MSG, *context]
     
     # Generate response
     response = await generate_chat_response(formatted_messages)
     
     # Save AI message to database
-    ai_message = await Message.prisma().create(
-        data={
-            "content": response.content,
-            "chatId": chat_id,
-            "userId": user_id,  # Using the same user ID for simplicity
-            "isAI": True,
-        }
-    )
-    
-    return ai_message
\ No newline at end of file
+    ai_message = await save_ai_message(chat_id, user_id, response.content)
+    return ai_message
+
+
+async def stream_ai_response(chat_id: str) -> AsyncIterator[str]:
+    """
+    Generate an AI response to the latest messages in a chat, yielding the
+    text as it arrives. The caller saves the full response with `save_ai_message`.
+    """
+    context = await get_context_window(chat_id)
+    async for delta in generate_chat_response_stream([SYSTEM_MSG, *context]):
+        yield delta
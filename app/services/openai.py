@@ -1,15 +1,22 @@
+import hashlib
 import logging
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 
-from openai import OpenAI
+from cachetools import TTLCache
+from openai import APIError, AsyncOpenAI
 from pydantic import BaseModel
 
 from app.core.config import settings
 
 # Configure OpenAI
-client = OpenAI(api_key=settings.OPENAI_API_KEY)
+client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
 MODEL = settings.OPENAI_MODEL
 
+# Verdicts for short, frequently repeated content such as greetings. Longer
+# content is almost always unique, so caching it would only churn the cache.
+_moderation_cache: TTLCache = TTLCache(maxsize=50000, ttl=settings.MODERATION_CACHE_TTL_SECONDS)
+MODERATION_CACHE_MAX_LENGTH = 256
+
 logger = logging.getLogger(__name__)
 
 
@@ -33,28 +40,54 @@ async def generate_chat_response(
     """Generate a response from OpenAI Chat models."""
     model = model or MODEL
     
+    formatted_messages = [{"role": msg.role, "content": msg.content} for msg in messages]
+    
     try:
-        formatted_messages = [{"role": msg.role, "content": msg.content} for msg in messages]
-        
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=model,
             messages=formatted_messages,
             temperature=temperature,
             max_tokens=max_tokens,
         )
-        
-        completion = response.choices[0].message.content
-        tokens_used = response.usage.total_tokens
-        
-        return ChatCompletion(
-            content=completion,
+    except APIError as e:
+        logger.error(f"Error generating chat response: {str(e)}")
+        raise
+    
+    completion = response.choices[0].message.content
+    tokens_used = response.usage.total_tokens
+    
+    return ChatCompletion(
+        content=completion,
+        model=model,
+        tokens_used=tokens_used,
+    )
+
+
+async def generate_chat_response_stream(
+    messages: List[Message],
+    model: Optional[str] = None,
+    temperature: float = 0.7,
+    max_tokens: int = 1000,
+) -> AsyncIterator[str]:
+    """Generate a response from OpenAI Chat models, yielding the text as it arrives."""
+    model = model or MODEL
+    
+    formatted_messages = [{"role": msg.role, "content": msg.content} for msg in messages]
+    
+    try:
+        stream = await client.chat.completions.create(
             model=model,
-            tokens_used=tokens_used,
+            messages=formatted_messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
         )
-    
-    except Exception as e:
-        logger.error(f"Error generating chat response: {str(e)}")
-        raise Exception(f"Failed to generate response: {str(e)}")
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except APIError as e:
+        logger.error(f"Error streaming chat response: {str(e)}")
+        raise
 
 
 async def moderate_content(content: str) -> bool:
@@ -62,10 +95,21 @@ async def moderate_content(content: str) -> bool:
     Check if content is appropriate using OpenAI's moderation endpoint.
     Returns True if content is flagged, False otherwise.
     """
+    cache_key = None
+    if len(content) <= MODERATION_CACHE_MAX_LENGTH:
+        cache_key = hashlib.sha256(content.encode()).digest()
+        flagged = _moderation_cache.get(cache_key)
+        if flagged is not None:
+            return flagged
+    
     try:
-        response = client.moderations.create(input=content)
-        return response.results[0].flagged
-    except Exception as e:
+        response = await client.moderations.create(input=content)
+    except APIError as e:
         logger.error(f"Error moderating content: {str(e)}")
         # Default to not flagged if moderation fails
-        return False
\ No newline at end of file
+        return False
+    
+    flagged = response.results[0].flagged
+    if cache_key is not None:
+        _moderation_cache[cache_key] = flagged
+    return flagged
\ No newline at end of file
@@ -0,0 +1,83 @@
+import logging
+import random
+from typing import Dict, Optional
+
+from prisma import Prisma
+from prisma.models import Chat, Message, Stat, User
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+USERS_TOTAL = "users_total"
+CHATS_TOTAL = "chats_total"
+MESSAGES_TOTAL = "messages_total"
+AI_MESSAGES_TOTAL = "messages_ai_total"
+
+COUNTER_KEYS = [USERS_TOTAL, CHATS_TOTAL, MESSAGES_TOTAL, AI_MESSAGES_TOTAL]
+
+
+async def seed_stats() -> None:
+    """Create any missing counter rows from a one-off count of each table."""
+    counters = {
+        USERS_TOTAL: lambda: User.prisma().count(),
+        CHATS_TOTAL: lambda: Chat.prisma().count(),
+        MESSAGES_TOTAL: lambda: Message.prisma().count(),
+        AI_MESSAGES_TOTAL: lambda: Message.prisma().count(where={"isAI": True}),
+    }
+
+    existing = await Stat.prisma().find_many(where={"key": {"in": list(counters)}})
+    existing_keys = {stat.key for stat in existing}
+
+    for key, count in counters.items():
+        # A new counter starts from a count of the table, held in shard 0.
+        # Shards added by raising STATS_SHARDS start at zero.
+        value = await count() if key not in existing_keys else 0
+        # Every worker seeds at startup; if another one got here first, keep its rows
+        await Stat.prisma().create_many(
+            data=[
+                {"key": key, "shard": shard, "value": value if shard == 0 else 0}
+                for shard in range(settings.STATS_SHARDS)
+            ],
+            skip_duplicates=True,
+        )
+        if key not in existing_keys:
+            logger.info(f"Seeded {key} counter with {value}")
+
+
+async def increment_stats(
+    client: Optional[Prisma] = None,
+    users: int = 0,
+    chats: int = 0,
+    messages: int = 0,
+    ai_messages: int = 0,
+) -> None:
+    """
+    Adjust the running counters by the given amounts.
+    Pass the transaction the counted rows are written in so the change to the
+    counters commits or rolls back with them.
+    """
+    deltas = {
+        USERS_TOTAL: users,
+        CHATS_TOTAL: chats,
+        MESSAGES_TOTAL: messages,
+        AI_MESSAGES_TOTAL: ai_messages,
+    }
+    # Each counter is split over several rows, and each write picks one at
+    # random. Concurrent transactions then rarely wait on the same row lock.
+    shard = random.randrange(settings.STATS_SHARDS)
+    for key, delta in deltas.items():
+        if delta:
+            await Stat.prisma(client).update(
+                where={"key_shard": {"key": key, "shard": shard}},
+                data={"value": {"increment": delta}},
+            )
+
+
+async def get_stats() -> Dict[str, int]:
+    """Get all running counters in a single query."""
+    stats = await Stat.prisma().find_many(where={"key": {"in": COUNTER_KEYS}})
+    totals = dict.fromkeys(COUNTER_KEYS, 0)
+    for stat in stats:
+        totals[stat.key] += stat.value
+    return totals
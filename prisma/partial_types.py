@@ -0,0 +1,8 @@
+from prisma.models import User
+
+# Users as returned by the API: reading these selects only the listed
+# columns, so password hashes never leave the database
+User.create_partial(
+    "PublicUser",
+    exclude=["passwordHash", "ownedChats", "messages", "chatParticipants"],
+)